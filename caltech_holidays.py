@@ -2,25 +2,54 @@
 
 import argparse
 from collections import namedtuple
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+import html
+from io import BytesIO
+import re
 import sys
 import hashlib
-from icalendar import Calendar, Event
+from icalendar import Calendar, Event, vDate, vDatetime, vText
 from pathlib import Path
-from lxml.html import parse
-from urllib.request import urlopen, Request
-from urllib.error import HTTPError
+from lxml.etree import HTMLPullParser, XPath
+from lxml.html import HtmlElementClassLookup
+import requests
 import logging
 
 LOGGER = logging.getLogger('Holidays')
 
+# Reuse one connection pool so keep-alive avoids repeated TLS handshakes
+_SESSION = requests.Session()
+_SESSION.headers['User-Agent'] = 'caltech_holidays'
+# requests already sends Accept-Encoding for every compression urllib3 can
+# decode (including brotli when installed), response.raw decodes it
+
 ERROR_GET_PAGE_FAILED = 1
 ERROR_PARSE_FAILED = 2
 ERROR_NO_EVENTS = 3
 ERROR_UNKNOWN = 255
 
+# returned by request_holiday_page when the server replies 304
+NOT_MODIFIED = object()
+
 Holiday = namedtuple("Holiday", ["date", "description"])
 
+_XP_HEADERS = XPath('//h3')
+_XP_TABLE = XPath('*/table')
+_XP_ROWS = XPath('tbody/tr')
+
+_RE_YEAR = re.compile(rb'<h3[^>]*>\s*Caltech Holiday Observances for (\d{4})\s*</h3>')
+_RE_ROW = re.compile(rb'<tr[^>]*>(.*?)</tr>', re.S)
+_RE_CELL = re.compile(rb'<td[^>]*>([^<]*)</td>')
+
+_RE_ICAL_UID = re.compile(rb'^UID:(\S+)\r?$', re.M)
+
+_MONTHS = {
+    'January': 1, 'February': 2, 'March': 3, 'April': 4,
+    'May': 5, 'June': 6, 'July': 7, 'August': 8,
+    'September': 9, 'October': 10, 'November': 11, 'December': 12,
+}
+
 def main(cmdline=None):
     parser = make_parser()
     args = parser.parse_args(cmdline)
@@ -32,28 +61,60 @@ def main(cmdline=None):
     else:
         logging.basicConfig(level=logging.WARN)
 
-    request = request_holiday_page()
+    # --display and --verify-uids need the calendar loaded even when the
+    # page is unchanged
+    if args.display or args.verify_uids:
+        last_modified = None
+    else:
+        last_modified = read_last_modified(args.icalendar)
+    request = request_holiday_page(last_modified)
     if request is None:
         LOGGER.error("Downloading holiday page failed")
         return ERROR_GET_PAGE_FAILED
+    elif request is NOT_MODIFIED:
+        LOGGER.info("Holiday page not modified since %s", last_modified)
+        return 0
 
-    dtstamp = parse_last_modified(request.headers['Last-Modified'])
+    dtstamp = parse_last_modified(request.headers.get('Last-Modified'))
     if dtstamp is None:
         LOGGER.error('No Last-Modified header')
         return ERROR_PARSE_FAILED
 
-    tree = parse(request)
+    data = request.raw.read()
+    entries = scan_calendar_entries(data)
+    if entries is None:
+        LOGGER.info('Page layout not recognized, parsing full HTML')
+        entries = iter_calendar_entries(BytesIO(data))
+    entries = list(entries)
+
+    if not (args.display or args.verify_uids) and len(entries) > 0:
+        # Avoid parsing the existing calendar if it already has everything
+        known_uids = read_known_uids(args.icalendar)
+        if all(make_uid(d, description) in known_uids for d, description in entries):
+            LOGGER.info('No new holidays')
+            if not args.dry_run:
+                write_last_modified(args.icalendar, request.headers.get('Last-Modified'))
+            return 0
 
     cal = create_or_load_icalendar(args.icalendar)
+    if args.verify_uids:
+        get_known_event_uids(cal, verify=True)
 
+    known_keys = get_known_event_keys(cal)
     event_count = 0
-    for date, description in get_calendar_entries(tree):
+    for holiday_date, description in entries:
         event_count += 1
-        add_unique_event(cal, make_event(date, description, dtstamp))
+        key = make_dedup_key(holiday_date, description)
+        if key in known_keys:
+            # only build events we are going to keep
+            continue
+        cal.add_component(make_event(holiday_date, description, dtstamp))
+        known_keys.add(key)
 
     if not args.dry_run:
         with open(args.icalendar, 'wb') as outstream:
-            outstream.write(cal.to_ical())
+            write_icalendar(cal, outstream)
+        write_last_modified(args.icalendar, request.headers.get('Last-Modified'))
 
     if args.display:
         print(display(cal).decode('utf-8'))
@@ -65,26 +126,36 @@ def main(cmdline=None):
     return 0
 
 
-def request_holiday_page():
+def request_holiday_page(last_modified=None):
     url = "https://hr.caltech.edu/resources/holiday-observances"
+    headers = {}
+    if last_modified is not None:
+        headers['If-Modified-Since'] = last_modified
     try:
-        request = Request(url)
-        request.add_header("user-agent", "caltech_holidays")
-        response = urlopen(request)
-    except HTTPError as e:
-        LOGGER.error("HTTP Request error: {} {}".format(e.code, e.reason))
-        print(e.headers)
+        response = _SESSION.get(url, headers=headers, stream=True)
+        if response.status_code == 304:
+            response.close()
+            return NOT_MODIFIED
+        response.raise_for_status()
+    except requests.HTTPError as e:
+        LOGGER.error("HTTP Request error: {} {}".format(
+            e.response.status_code, e.response.reason))
+        print(e.response.headers)
+        return None
+    except requests.RequestException as e:
+        LOGGER.error("HTTP Request error: {}".format(e))
         return None
 
-    if response.status != 200:
-        LOGGER.error('Error opening page: {}'.format(request.status))
+    if response.status_code != 200:
+        LOGGER.error('Error opening page: {}'.format(response.status_code))
         return None
 
+    response.raw.decode_content = True
     return response
 
 
 def get_calendar_entries(tree):
-    headers = tree.xpath('//h3')
+    headers = _XP_HEADERS(tree)
     LOGGER.debug('Found {} header tags'.format(len(headers)))
     for h in headers:
         year = get_year_from_header(h)
@@ -96,8 +167,55 @@ def get_calendar_entries(tree):
         yield from get_table_entries(year, table)
 
 
+def iter_calendar_entries(stream):
+    """Incrementally parse stream yielding holidays as each table closes
+
+    Unlike get_calendar_entries this never holds the whole document,
+    processed elements are discarded once their entries are yielded.
+    """
+    year = None
+    for elem in iterparse_html(stream, ('h3', 'table')):
+        if elem.tag == 'h3':
+            year = get_year_from_header(elem)
+            LOGGER.debug('year: %s', year)
+        elif year is not None and is_holiday_table(elem):
+            yield from get_table_entries(year, elem)
+            year = None
+        else:
+            continue
+
+        # release everything parsed so far
+        elem.clear(keep_tail=True)
+        for ancestor in elem.iterancestors():
+            while ancestor.getprevious() is not None:
+                del ancestor.getparent()[0]
+
+
+def iterparse_html(stream, tag, chunk_size=16384):
+    """Yield lxml.html elements matching tag as their end tags are read"""
+    parser = HTMLPullParser(events=('end',), tag=tag)
+    parser.set_element_class_lookup(HtmlElementClassLookup())
+    while True:
+        data = stream.read(chunk_size)
+        if not data:
+            break
+        parser.feed(data)
+        for _, elem in parser.read_events():
+            yield elem
+    parser.close()
+    for _, elem in parser.read_events():
+        yield elem
+
+
+def is_holiday_table(table):
+    for ancestor in table.iterancestors('section'):
+        if ancestor.attrib.get('class') == 'block-TableBlock':
+            return True
+    return False
+
+
 def get_year_from_header(header):
-    header = header.text_content().strip()
+    header = get_element_text(header)
     if not header.startswith('Caltech Holiday Observances for '):
         LOGGER.error('Unrecognized table title: %s', header)
         return None
@@ -105,36 +223,113 @@ def get_year_from_header(header):
     return header[-4:]
 
 
+def get_element_text(element):
+    """Return stripped text of element, only walking children if it has any"""
+    if len(element) == 0 and element.text is not None:
+        return element.text.strip()
+    return element.text_content().strip()
+
+
 def get_table_from_header(header):
     section = header.getparent()
     node = section.getnext()
     while node is not None:
         if node.attrib.get('class') == 'block-TableBlock':
-            tables = node.xpath('*/table')
+            tables = _XP_TABLE(node)
             assert len(tables) == 1, 'page layout changed'
             return tables[0]
         node = node.getnext()
 
 
 def get_table_entries(year, table):
-    for row in table.xpath('tbody/tr'):
-        record = row.getchildren()
-        if len(record) == 4:
-            day = record[2].text_content().strip()
-            description = record[3].text_content().strip()
-            LOGGER.debug('day: %s', day)
-            if not day.startswith('-'):
-                LOGGER.debug('description: %s', description)
-                try:
-                    # in case there's an overriden year
-                    date = datetime.strptime(day, "%B %d, %Y").date()
-                except ValueError:
-                    date = datetime.strptime(year + ' ' + day, '%Y %B %d').date()
-                yield Holiday(date, description)
-            elif description == "Personal Holiday":
-                pass
-            else:
-                LOGGER.info('unrecognized calendar line: {}'.format(row.text_content()))
+    for row in _XP_ROWS(table):
+        if len(row) == 4:
+            day = get_element_text(row[2])
+            description = get_element_text(row[3])
+            holiday = make_holiday(year, day, description)
+            if holiday is not None:
+                yield holiday
+
+
+def make_holiday(year, day, description):
+    """Return the Holiday for one table row or None if it has no date"""
+    LOGGER.debug('day: %s', day)
+    if not day.startswith('-'):
+        LOGGER.debug('description: %s', description)
+        return Holiday(parse_holiday_date(year, day), description)
+    elif description == "Personal Holiday":
+        pass
+    else:
+        LOGGER.info('unrecognized calendar line: {} {}'.format(day, description))
+    return None
+
+
+def scan_calendar_entries(data):
+    """Extract holidays from the raw page bytes with regular expressions
+
+    This avoids building a DOM for the common case. Returns None if
+    any table does not look the way we expect, so the caller can fall
+    back to iter_calendar_entries.
+    """
+    headers = list(_RE_YEAR.finditer(data))
+    if len(headers) != data.count(b'Caltech Holiday Observances for'):
+        # some heading has markup the regular expression doesn't handle
+        return None
+
+    holidays = []
+    for m in headers:
+        year = m.group(1).decode('ascii')
+        LOGGER.debug('year: %s', year)
+        # the table has to belong to this heading, not the next one
+        section_end = data.find(b'<h3', m.end())
+        if section_end == -1:
+            section_end = len(data)
+        section_start = data.find(b'block-TableBlock', m.end(), section_end)
+        if section_start == -1:
+            return None
+        body_start = data.find(b'<tbody', section_start, section_end)
+        if body_start == -1:
+            return None
+        body_end = data.find(b'</tbody>', body_start, section_end)
+        if body_end == -1:
+            return None
+
+        rows = _RE_ROW.findall(data, body_start, body_end)
+        if len(rows) != data.count(b'<tr', body_start, body_end):
+            return None
+
+        for row in rows:
+            cells = _RE_CELL.findall(row)
+            if len(cells) != 4 or row.count(b'<td') != 4:
+                return None
+            try:
+                day, description = (
+                    html.unescape(c.decode('utf-8')).strip() for c in cells[2:])
+            except UnicodeDecodeError:
+                return None
+            holiday = make_holiday(year, day, description)
+            if holiday is not None:
+                holidays.append(holiday)
+
+    if len(holidays) == 0:
+        return None
+
+    return holidays
+
+
+def parse_holiday_date(year, day):
+    """Convert "<Month> <day>" or "<Month> <day>, <year>" to a date"""
+    try:
+        month, day_of_month = day.split(None, 1)
+        if ',' in day_of_month:
+            # in case there's an overriden year
+            day_of_month, year = day_of_month.split(',', 1)
+        return date(int(year), _MONTHS[month], int(day_of_month))
+    except (KeyError, ValueError):
+        try:
+            return datetime.strptime(day, "%B %d, %Y").date()
+        except ValueError:
+            return datetime.strptime(year + ' ' + day, '%Y %B %d').date()
 
 
 def create_or_load_icalendar(filename=None):
@@ -152,6 +347,49 @@ def create_or_load_icalendar(filename=None):
 
     return cal
 
+def read_known_uids(filename):
+    """Return the UIDs stored in an icalendar file without parsing it"""
+    filename = Path(filename)
+    if not filename.exists():
+        return set()
+
+    with filename.open('rb') as stream:
+        raw = stream.read()
+    return set(m.group(1).decode('utf-8') for m in _RE_ICAL_UID.finditer(raw))
+
+
+def get_last_modified_filename(filename):
+    filename = Path(filename)
+    return filename.with_name(filename.name + '.last-modified')
+
+
+def read_last_modified(filename):
+    """Return the Last-Modified header saved alongside filename
+
+    Returns None if there is no saved value or the calendar itself is
+    missing, so that a fresh calendar is always downloaded.
+    """
+    if not Path(filename).exists():
+        return None
+
+    sidecar = get_last_modified_filename(filename)
+    if not sidecar.exists():
+        return None
+
+    last_modified = sidecar.read_text().strip()
+    return last_modified if last_modified else None
+
+
+def write_last_modified(filename, last_modified):
+    sidecar = get_last_modified_filename(filename)
+    if last_modified is None:
+        if sidecar.exists():
+            sidecar.unlink()
+        return
+
+    sidecar.write_text(last_modified + '\n')
+
+
 def make_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("-n", "--dry-run", action="store_true", default=False,
@@ -160,6 +398,8 @@ def make_parser():
                         help='Name to write icalendar file to')
     parser.add_argument('--display', default=False, action='store_true',
                         help='Print calendar')
+    parser.add_argument('--verify-uids', default=False, action='store_true',
+                        help='warn about stored events with outdated UIDs')
     parser.add_argument('-v', '--verbose', default=False, action='store_true',
                         help='enable INFO level log messages')
     parser.add_argument('-vv', '--debug', default=False, action='store_true',
@@ -167,6 +407,21 @@ def make_parser():
     return parser
 
 
+def write_icalendar(cal, outstream):
+    """Write cal one component at a time
+
+    Produces the same bytes as cal.to_ical() without first building the
+    whole serialized calendar in memory.
+    """
+    properties = cal.property_items(recursive=False)
+    end = properties.pop()
+    for name, value in properties:
+        outstream.write(cal.content_line(name, value).to_ical() + b'\r\n')
+    for component in cal.subcomponents:
+        outstream.write(component.to_ical())
+    outstream.write(cal.content_line(*end).to_ical() + b'\r\n')
+
+
 def display(cal):
     return cal.to_ical().replace(b'\r\n', b'\n').strip()
 
@@ -175,18 +430,27 @@ def parse_last_modified(header):
     if header is None:
         return datetime.now()
 
-    return datetime.strptime(header, '%a, %d %b %Y %H:%M:%S %Z')
+    return parsedate_to_datetime(header)
 
 
 def make_event(event_date, description, dtstamp):
+    # Set the property values directly rather than through Event.add to
+    # skip its type detection, which means doing what it would do for
+    # dates and the UTC DTSTAMP ourselves.
     event = Event()
     tomorrow = event_date + timedelta(days=1)
     uid = make_uid(event_date, description)
-    event.add('uid', uid)
-    event.add('dtstart', event_date)
-    event.add('dtend', tomorrow)
-    event.add('dtstamp', dtstamp)
-    event.add('summary', description)
+    if dtstamp.tzinfo is None:
+        dtstamp = dtstamp.replace(tzinfo=timezone.utc)
+    else:
+        dtstamp = dtstamp.astimezone(timezone.utc)
+    event['UID'] = vText(uid)
+    event['DTSTART'] = vDate(event_date, params={'VALUE': 'DATE'})
+    event['DTEND'] = vDate(tomorrow, params={'VALUE': 'DATE'})
+    event['DTSTAMP'] = vDatetime(dtstamp)
+    event['SUMMARY'] = vText(description)
+    # we just computed the canonical UID, remember it for get_event_uid
+    event._uid_cache = uid
     return event
 
 
@@ -197,6 +461,10 @@ def make_uid(event_date, description):
 
 
 def get_event_uid(event):
+    cached_uid = getattr(event, '_uid_cache', None)
+    if cached_uid is not None:
+        return cached_uid
+
     stored_uid = str(event["UID"])
     event_date = event["DTSTART"].dt
     description = event["SUMMARY"]
@@ -211,22 +479,57 @@ def get_event_uid(event):
     return new_uid
 
 
-def get_known_event_uids(cal):
+def get_known_event_uids(cal, verify=False):
+    """Return the UIDs of the events in cal
+
+    With verify the UIDs are recomputed from the event contents, warning
+    about any stored UID that does not match.
+    """
+    seen = set()
+
+    for e in cal.subcomponents:
+        if e.name == "VEVENT":
+            if verify:
+                seen.add(get_event_uid(e))
+            else:
+                seen.add(str(e["UID"]))
+
+    return seen
+
+
+def make_dedup_key(event_date, description):
+    """Cheap in-process key identifying the same holiday as make_uid"""
+    return (event_date.toordinal(), str(description))
+
+
+def get_event_dedup_key(event):
+    return make_dedup_key(event["DTSTART"].dt, event["SUMMARY"])
+
+
+def get_known_event_keys(cal):
     seen = set()
 
-    for e in cal.walk():
-        if e.has_key("UID"):
-            seen.add(get_event_uid(e))
+    for e in cal.subcomponents:
+        if e.name == "VEVENT":
+            seen.add(get_event_dedup_key(e))
 
     return seen
 
 
-def add_unique_event(cal, event):
-    known_uids = get_known_event_uids(cal)
-    uid = get_event_uid(event)
+def add_unique_event(cal, event, known_keys=None):
+    """Add event to cal unless the same holiday is already present
+
+    known_keys is updated with the new event so callers adding many events
+    can compute it once with get_known_event_keys instead of rescanning
+    the calendar for every insertion.
+    """
+    if known_keys is None:
+        known_keys = get_known_event_keys(cal)
+    key = get_event_dedup_key(event)
 
-    if uid not in known_uids:
+    if key not in known_keys:
         cal.add_component(event)
+        known_keys.add(key)
 
 
 if __name__ == '__main__':
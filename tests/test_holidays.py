@@ -1,26 +1,44 @@
-from datetime import date, datetime
+from datetime import date, datetime, timezone
+from io import BytesIO, StringIO
 from lxml.html import parse, fromstring
 from pathlib import Path
+from tempfile import TemporaryDirectory
 from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+import caltech_holidays
 
 from caltech_holidays import (
     Calendar,
     get_calendar_entries,
     get_event_uid,
+    get_last_modified_filename,
+    get_known_event_keys,
     get_known_event_uids,
     get_table_from_header,
     get_table_entries,
     get_year_from_header,
+    iter_calendar_entries,
+    main,
     add_unique_event,
     make_event,
+    parse_holiday_date,
+    parse_last_modified,
+    read_known_uids,
+    read_last_modified,
+    scan_calendar_entries,
+    write_icalendar,
+    write_last_modified,
 )
 
+TESTDATA = Path(__file__).parent / "holiday-observances.html"
+
 
 class TestCaltechHolidays(TestCase):
     def setUp(self):
-        testdata = Path(__file__).parent / "holiday-observances.html"
-        with open(testdata, "rt") as instream:
+        with open(TESTDATA, "rt") as instream:
             self.tree = parse(instream)
+        self.data = TESTDATA.read_bytes()
 
     def test_get_calendar_entries(self):
         count = 0
@@ -29,6 +47,44 @@ class TestCaltechHolidays(TestCase):
 
         self.assertEqual(count, 30)
 
+    def test_iter_calendar_entries(self):
+        entries = list(iter_calendar_entries(BytesIO(self.data)))
+
+        self.assertEqual(entries, list(get_calendar_entries(self.tree)))
+        self.assertEqual(len(entries), 30)
+
+    def test_scan_calendar_entries(self):
+        entries = scan_calendar_entries(self.data)
+
+        self.assertEqual(entries, list(get_calendar_entries(self.tree)))
+
+    def test_scan_calendar_entries_unrecognized(self):
+        testdata = b"""<h3>Caltech Holiday Observances for 2024</h3>
+<table><tbody>
+<tr><td>1</td><td>Monday</td><td><b>January 1</b></td><td>New Year's Day</td></tr>
+</tbody></table>"""
+        self.assertIsNone(scan_calendar_entries(testdata))
+
+    def test_scan_calendar_entries_bad_encoding(self):
+        data = self.data.replace(b"New Year's Day", b"New Year's D\xe9a")
+        self.assertIsNone(scan_calendar_entries(data))
+        self.assertEqual(len(list(iter_calendar_entries(BytesIO(data)))), 30)
+
+    def test_scan_calendar_entries_header_markup(self):
+        data = self.data.replace(
+            b"Caltech Holiday Observances for 2025",
+            b"<span>Caltech Holiday Observances for 2025</span>")
+
+        self.assertIsNone(scan_calendar_entries(data))
+
+    def test_scan_calendar_entries_header_without_table(self):
+        first_header = self.data.index(b"<h3")
+        data = (self.data[:first_header]
+                + b"<h3>Caltech Holiday Observances for 2023</h3>\n"
+                + self.data[first_header:])
+
+        self.assertIsNone(scan_calendar_entries(data))
+
     def test_get_table_entries(self):
         testdata = ["<table><thead></thead><tbody>"]
         testdata.append("<tr><td>1</td><td>Monday</td><td>January 1</td><td>New Year's Day</td></tr>")
@@ -43,6 +99,16 @@ class TestCaltechHolidays(TestCase):
         self.assertEqual(entries[1].date, date(2024, 1, 15))
         self.assertEqual(entries[1].description, "Martin Luther King")
 
+    def test_get_table_entries_nested_markup(self):
+        testdata = ["<table><thead></thead><tbody>"]
+        testdata.append("<tr><td>1</td><td>Monday</td><td><p>January 1</p></td><td>New Year's <b>Day</b></td></tr>")
+        testdata.append("</tbody></table>")
+        tree = fromstring("\n".join(testdata))
+
+        entries = list(get_table_entries("2024", tree))
+        self.assertEqual(entries[0].date, date(2024, 1, 1))
+        self.assertEqual(entries[0].description, "New Year's Day")
+
     def test_get_table_personal_holiday(self):
         testdata = ["<table><thead></thead><tbody>"]
         testdata.append("<tr><td>13</td><td>-</td><td>-</td><td>Personal Holiday</td></tr>")
@@ -52,6 +118,10 @@ class TestCaltechHolidays(TestCase):
 
         self.assertEqual(len(entries), 0)
 
+    def test_parse_holiday_date(self):
+        self.assertEqual(parse_holiday_date("2024", "January 15"), date(2024, 1, 15))
+        self.assertEqual(parse_holiday_date("2024", "December 31, 2023"), date(2023, 12, 31))
+
     def test_get_year_from_header(self):
         testdata = "<h3>Caltech Holiday Observances for 2024</h3>"
         tree = fromstring(testdata)
@@ -59,6 +129,11 @@ class TestCaltechHolidays(TestCase):
         year = get_year_from_header(tree)
         self.assertEqual(year, "2024")
         
+    def test_parse_last_modified(self):
+        self.assertEqual(
+            parse_last_modified("Mon, 27 Mar 2023 18:58:43 GMT"),
+            datetime(2023, 3, 27, 18, 58, 43, tzinfo=timezone.utc))
+
     def test_make_event(self):
         event1 = make_event(date(2024, 1, 1), "test_event", datetime(2023, 5, 1, 12, 34))
         event2 = make_event(date(2024, 1, 1), "test_event", datetime(2023, 10, 1, 12, 34))
@@ -67,6 +142,9 @@ class TestCaltechHolidays(TestCase):
         self.assertEqual(event1["DTSTART"].dt, date(2024, 1, 1))
         self.assertEqual(event1["DTEND"].dt, date(2024, 1, 2))
         self.assertEqual(event1["UID"], event2["UID"])
+        self.assertEqual(get_event_uid(event1), event1["UID"])
+        self.assertIn(b"DTSTART;VALUE=DATE:20240101\r\n", event1.to_ical())
+        self.assertIn(b"DTSTAMP:20230501T123400Z\r\n", event1.to_ical())
 
     def test_get_event_uid(self):
         event1 = make_event(date(2023, 1, 2), "New Year's Day", datetime(2022, 10, 1, 12, 34))
@@ -99,6 +177,7 @@ END:VEVENT
             "6a7547b3f94c71ce0f5458bbac92efdd98c39bb7e3bb2ffcf28da6dcd0076f1f",
             "771ed7592fc59d584934c0b8302d3c09cb7a3c9c2d3787bec86dbabfd7741bac",
         )))
+        self.assertEqual(get_known_event_uids(cal, verify=True), uids)
         
     def test_merging_events(self):
         dtstamp = datetime(2023, 5, 1, 12, 34)
@@ -115,3 +194,207 @@ END:VEVENT
 
         add_unique_event(cal, event3)
         self.assertEqual(len(cal.subcomponents), 2)
+
+    def test_known_event_keys(self):
+        event1 = make_event(date(2024, 1, 1), "test_event1", datetime(2023, 10, 1, 12, 34))
+        event2 = make_event(date(2024, 1, 15), "test_event2", datetime(2023, 10, 1, 12, 34))
+
+        cal = Calendar()
+        cal.add_component(event1)
+        cal.add_component(event2)
+
+        keys = get_known_event_keys(cal)
+        self.assertEqual(keys, set((
+            (date(2024, 1, 1).toordinal(), "test_event1"),
+            (date(2024, 1, 15).toordinal(), "test_event2"),
+        )))
+
+    def test_merging_events_with_known_keys(self):
+        dtstamp = datetime(2023, 5, 1, 12, 34)
+        event1 = make_event(date(2024, 1, 1), "test_event1", dtstamp)
+        event2 = make_event(date(2024, 1, 1), "test_event1", dtstamp)
+
+        cal = Calendar()
+        known_keys = get_known_event_keys(cal)
+        add_unique_event(cal, event1, known_keys)
+        self.assertEqual(len(known_keys), 1)
+
+        add_unique_event(cal, event2, known_keys)
+        self.assertEqual(len(cal.subcomponents), 1)
+
+    def test_last_modified_sidecar(self):
+        last_modified = "Mon, 27 Mar 2023 18:58:43 GMT"
+        with TemporaryDirectory() as tempdir:
+            icalendar = Path(tempdir) / "holidays.ics"
+            write_last_modified(icalendar, last_modified)
+            # without the calendar we need to download again
+            self.assertIsNone(read_last_modified(icalendar))
+
+            icalendar.write_text("")
+            self.assertEqual(read_last_modified(icalendar), last_modified)
+
+            write_last_modified(icalendar, None)
+            self.assertIsNone(read_last_modified(icalendar))
+
+    def test_write_icalendar(self):
+        dtstamp = datetime(2023, 5, 1, 12, 34)
+        cal = Calendar()
+        cal.add('version', '2.0')
+        cal.add('prodid', 'ghic.org:caltech_holiday.py')
+        add_unique_event(cal, make_event(date(2024, 1, 1), "test_event1", dtstamp))
+        add_unique_event(cal, make_event(date(2024, 1, 15), "test_event2", dtstamp))
+
+        outstream = BytesIO()
+        write_icalendar(cal, outstream)
+        self.assertEqual(outstream.getvalue(), cal.to_ical())
+
+    def test_read_known_uids(self):
+        dtstamp = datetime(2023, 5, 1, 12, 34)
+        cal = Calendar()
+        cal.add('version', '2.0')
+        cal.add('prodid', 'ghic.org:caltech_holiday.py')
+        add_unique_event(cal, make_event(date(2024, 1, 1), "test_event1", dtstamp))
+        add_unique_event(cal, make_event(date(2024, 1, 15), "test_event2", dtstamp))
+
+        with TemporaryDirectory() as tempdir:
+            icalendar = Path(tempdir) / "holidays.ics"
+            self.assertEqual(read_known_uids(icalendar), set())
+
+            with open(icalendar, "wb") as outstream:
+                write_icalendar(cal, outstream)
+            self.assertEqual(read_known_uids(icalendar), get_known_event_uids(cal))
+
+
+class TestMain(TestCase):
+    last_modified = "Mon, 27 Mar 2023 18:58:43 GMT"
+
+    def setUp(self):
+        self.data = TESTDATA.read_bytes()
+
+    def make_response(self, status_code, data=None):
+        response = MagicMock()
+        response.status_code = status_code
+        response.headers = {"Last-Modified": self.last_modified}
+        response.raw = BytesIO(self.data if data is None else data)
+        return response
+
+    def run_main(self, cmdline, response):
+        with patch.object(caltech_holidays._SESSION, "get", return_value=response) as get:
+            with patch("sys.stdout", new_callable=StringIO) as stdout:
+                result = main(cmdline)
+        return result, get, stdout.getvalue()
+
+    def test_download_writes_sidecar(self):
+        with TemporaryDirectory() as tempdir:
+            icalendar = Path(tempdir) / "holidays.ics"
+            result, get, _ = self.run_main(
+                ["--icalendar", str(icalendar)], self.make_response(200))
+
+            self.assertEqual(result, 0)
+            self.assertEqual(get.call_args.kwargs["headers"], {})
+            self.assertEqual(icalendar.read_bytes().count(b"BEGIN:VEVENT"), 30)
+            self.assertEqual(
+                get_last_modified_filename(icalendar).read_text().strip(),
+                self.last_modified)
+
+    def test_not_modified(self):
+        with TemporaryDirectory() as tempdir:
+            icalendar = Path(tempdir) / "holidays.ics"
+            icalendar.write_bytes(b"unchanged")
+            write_last_modified(icalendar, self.last_modified)
+
+            result, get, _ = self.run_main(
+                ["--icalendar", str(icalendar)], self.make_response(304))
+
+            self.assertEqual(result, 0)
+            self.assertEqual(
+                get.call_args.kwargs["headers"],
+                {"If-Modified-Since": self.last_modified})
+            self.assertEqual(icalendar.read_bytes(), b"unchanged")
+
+    def test_display_ignores_last_modified(self):
+        with TemporaryDirectory() as tempdir:
+            icalendar = Path(tempdir) / "holidays.ics"
+            self.run_main(["--icalendar", str(icalendar)], self.make_response(200))
+
+            result, get, output = self.run_main(
+                ["--icalendar", str(icalendar), "--display"],
+                self.make_response(200))
+
+            self.assertEqual(result, 0)
+            self.assertEqual(get.call_args.kwargs["headers"], {})
+            self.assertEqual(output.count("BEGIN:VEVENT"), 30)
+
+    def test_verify_uids_ignores_last_modified(self):
+        with TemporaryDirectory() as tempdir:
+            icalendar = Path(tempdir) / "holidays.ics"
+            self.run_main(["--icalendar", str(icalendar)], self.make_response(200))
+            ical = icalendar.read_bytes()
+            stored_uid = make_event(
+                date(2024, 1, 1), "New Year's Day", datetime(2023, 3, 27))["UID"]
+            icalendar.write_bytes(
+                ical.replace(stored_uid.encode("ascii"), b"oldstyle-uid"))
+
+            with self.assertLogs("Holidays", level="WARNING") as logs:
+                result, get, _ = self.run_main(
+                    ["--icalendar", str(icalendar), "--verify-uids"],
+                    self.make_response(200))
+
+            self.assertEqual(result, 0)
+            self.assertEqual(get.call_args.kwargs["headers"], {})
+            self.assertIn("oldstyle-uid", "\n".join(logs.output))
+
+    def test_fallback_to_lxml(self):
+        data = self.data.replace(
+            b"Martin Luther King, Jr. Day",
+            b"Martin Luther King, <b>Jr.</b> Day")
+        with TemporaryDirectory() as tempdir:
+            icalendar = Path(tempdir) / "holidays.ics"
+            result, _, _ = self.run_main(
+                ["--icalendar", str(icalendar)], self.make_response(200, data))
+
+            self.assertEqual(result, 0)
+            ical = icalendar.read_bytes()
+            self.assertEqual(ical.count(b"BEGIN:VEVENT"), 30)
+            self.assertIn(b"SUMMARY:Martin Luther King\\, Jr. Day", ical)
+
+    def test_unchanged_calendar_not_rewritten(self):
+        with TemporaryDirectory() as tempdir:
+            icalendar = Path(tempdir) / "holidays.ics"
+            self.run_main(["--icalendar", str(icalendar)], self.make_response(200))
+            ical = icalendar.read_bytes()
+            mtime = icalendar.stat().st_mtime_ns
+
+            response = self.make_response(200)
+            response.headers = {"Last-Modified": "Tue, 28 Mar 2023 10:00:00 GMT"}
+            with patch("caltech_holidays.create_or_load_icalendar") as load:
+                result, _, _ = self.run_main(["--icalendar", str(icalendar)], response)
+
+            self.assertEqual(result, 0)
+            load.assert_not_called()
+            self.assertEqual(icalendar.read_bytes(), ical)
+            self.assertEqual(icalendar.stat().st_mtime_ns, mtime)
+            self.assertEqual(
+                get_last_modified_filename(icalendar).read_text().strip(),
+                "Tue, 28 Mar 2023 10:00:00 GMT")
+
+    def test_new_holiday_appended(self):
+        with TemporaryDirectory() as tempdir:
+            icalendar = Path(tempdir) / "holidays.ics"
+            self.run_main(["--icalendar", str(icalendar)], self.make_response(200))
+
+            # copy the MLK day row as an extra holiday the next day
+            row_start = self.data.rindex(b"<tr", 0, self.data.index(b"January 15"))
+            row_end = self.data.index(b"</tr>", row_start) + len(b"</tr>")
+            extra = self.data[row_start:row_end].replace(
+                b"January 15", b"January 16").replace(
+                b"Martin Luther King, Jr. Day", b"Extra Holiday")
+            data = self.data[:row_end] + extra + self.data[row_end:]
+
+            result, _, _ = self.run_main(
+                ["--icalendar", str(icalendar)], self.make_response(200, data))
+
+            self.assertEqual(result, 0)
+            ical = icalendar.read_bytes()
+            self.assertEqual(ical.count(b"BEGIN:VEVENT"), 31)
+            self.assertEqual(ical.count(b"SUMMARY:Extra Holiday"), 1)